@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-# Requires Python >= 3.2 or >= 2.7
+# Requires Python >= 3.8
 
 __author__    = "TuxSH"
 __copyright__ = "Copyright (c) 2016-2023 TuxSH"
@@ -11,64 +11,87 @@ Parses Luma3DS exception dumps
 """
 
 import argparse
-from struct import unpack_from
+from struct import Struct
 
+import mmap
 import os
-import subprocess
+import stat
+import sys
+
+try:
+    import capstone
+except ImportError:
+    capstone = None
 
 # Source of hexdump: https://gist.github.com/1mm0rt41PC/c340564823f283fe530b
 # Credits for hexdump go to the original authors
 # Slightly edited by TuxSH
 
+_PRINTABLE = bytes(i if 0x20 <= i < 0x7F else ord('.') for i in range(256))
+
 def hexdump(addr, src, length=16, sep='.' ):
     '''
     @brief Return {src} in hex dump.
     @param[in] length   {Int} Nb Bytes by row.
     @param[in] sep      {Char} For the text part, {sep} will be used for non ASCII char.
     @return {Str} The hexdump
-    @note Full support for python2 and python3 !
+    @note Requires python >= 3.8 (memoryview.hex separator)
     '''
     result = []
 
-    # Python3 support
-    try:
-        xrange(0,1)
-    except NameError:
-        xrange = range
-
-    for i in xrange(0, len(src), length):
-        subSrc = src[i:i+length]
-        hexa = ''
-        isMiddle = False
-        for h in xrange(0,len(subSrc)):
-            if h == length/2:
-                hexa += ' '
-            h = subSrc[h]
-            if not isinstance(h, int):
-                h = ord(h)
-            h = hex(h).replace('0x','')
-            if len(h) == 1:
-                h = '0'+h
-            hexa += h+' '
-        hexa = hexa.strip(' ')
-        text = ''
-        for c in subSrc:
-            if not isinstance(c, int):
-                c = ord(c)
-            if 0x20 <= c < 0x7F:
-                text += chr(c)
-            else:
-                text += sep
-        result.append(('%08x:  %-'+str(length*(2+1)+1)+'s  |%s|') % (addr + i, hexa, text))
+    if sep == '.':
+        table = _PRINTABLE
+    else:
+        table = bytes(i if 0x20 <= i < 0x7F else ord(sep) for i in range(256))
+
+    # Convert the whole buffer at once, then cut the rows out of the results
+    mv = memoryview(src)
+    size = len(mv)
+    hexAll = mv.hex(' ')
+    textAll = mv.tobytes().translate(table).decode('ascii')
+
+    middle = 3 * (length // 2) if length % 2 == 0 else -1
+    width = length*(2+1)+1
+    for i in range(0, size, length):
+        hexa = hexAll[3*i : 3*min(i+length, size) - 1]
+        if 0 < middle < len(hexa):
+            hexa = hexa[:middle] + ' ' + hexa[middle:]
+        text = textAll[i:i+length]
+        result.append(f"{addr + i:08x}:  {hexa:<{width}}  |{text}|")
 
     return '\n'.join(result)
 
 
-def makeRegisterLine(A, rA, B, rB):
-    return "{0:<15}{1:<20}{2:<15}{3:<20}".format(A, "{0:08x}".format(rA), B, "{0:08x}".format(rB))
+def disassemble(addr, code, thumb):
+    '''
+    @brief Disassemble {code} in-process using Capstone.
+    @return {Str} The disassembly, or "" if Capstone is unavailable or fails
+    '''
+    if capstone is None:
+        return ""
+
+    try:
+        md = capstone.Cs(capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB if thumb else capstone.CS_MODE_ARM)
+        md.syntax = capstone.CS_OPT_SYNTAX_NOREGNAME
+        md.skipdata = True
+        code = bytes(code)
+        lines = []
+        done = 0
+        for i in md.disasm(code, addr):
+            lines.append(f"{i.address:08x}:  {i.bytes.hex(' '):<12}  {i.mnemonic}\t{i.op_str}")
+            done += i.size
+
+        # Capstone silently drops trailing bytes that don't form a whole instruction, even with skipdata
+        rest = code[done:]
+        if rest:
+            lines.append(f"{addr + done:08x}:  {rest.hex(' '):<12}  .byte\t{', '.join(f'{b:#04x}' for b in rest)}")
+        return '\n'.join(lines)
+    except Exception:
+        return ""
+
 
 handledExceptionNames = ("FIQ", "undefined instruction", "prefetch abort", "data abort")
-registerNames = tuple("r{0}".format(i) for i in range(13)) + ("sp", "lr", "pc", "cpsr") + ("dfsr", "ifsr", "far") + ("fpexc", "fpinst", "fpinst2")
+registerNames = tuple(f"r{i}" for i in range(13)) + ("sp", "lr", "pc", "cpsr") + ("dfsr", "ifsr", "far") + ("fpexc", "fpinst", "fpinst2")
 svcBreakReasons = ("(svcBreak: panic)", "(svcBreak: assertion failed)", "(svcBreak: user-related)")
 faultStatusSources = {
     0b1:'Alignment', 0b100:'Instruction cache maintenance operation fault',
@@ -77,17 +100,62 @@ faultStatusSources = {
     0b1001:'Domain - Section', 0b1011:'Domain - Page', 0b1101:'Permission - Section', 0b1111:'Permission - Page',
     0b1000:'Precise External Abort', 0b10110:'Imprecise External Abort', 0b10:'Debug event'
 }
+_FSR = tuple(faultStatusSources.get(i, "Unknown") for i in range(16))
+
+_HDR = Struct("<10I")
+_U16 = Struct("<H")
+_U32 = Struct("<I")
+_U64 = Struct("<Q")
+_REG_CACHE = {}
+
+def _resolveObjdumpPath():
+    if "DEVKITARM" not in os.environ:
+        return None
+
+    path = os.path.join(os.environ["DEVKITARM"], "bin", "arm-none-eabi-objdump")
+    if os.name == "nt" and path[0] == '/':
+        path = ''.join((path[1], ':', path[2:]))
+    return path
+
+_OBJDUMP_PATH = _resolveObjdumpPath()
+_REGNAMES_ARM = "reg-names-std"
+_REGNAMES_THUMB = "reg-names-std,force-thumb"
+
+def _readDump(f):
+    # Map regular files; pipes and the like (e.g. /dev/stdin, <(...)) can't be mapped, read them instead
+    if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+    return f.read()
 
 def main(args=None):
     parser = argparse.ArgumentParser(description="Parse Luma3DS exception dumps")
     parser.add_argument("filename")
     args = parser.parse_args()
-    data = b""
-    with open(args.filename, "rb") as f: data = f.read()
-    if unpack_from("<2I", data) != (0xdeadc0de, 0xdeadcafe):
+    with open(args.filename, "rb") as f:
+        data = _readDump(f)
+
+    try:
+        _parseDump(args.filename, data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            try:
+                data.close()
+            except BufferError:
+                # An exception traceback still references views of the mapping, it is freed along with them
+                pass
+
+def _parseDump(filename, data):
+    if len(data) < _HDR.size:
         raise SystemExit("Invalid file format")
 
-    version, processor, exceptionType, _, nbRegisters, codeDumpSize, stackDumpSize, additionalDataSize = unpack_from("<8I", data, 8)
+    hdr = _HDR.unpack_from(data)
+    if hdr[0] != 0xdeadc0de or hdr[1] != 0xdeadcafe:
+        raise SystemExit("Invalid file format")
+
+    version, processor, exceptionType, _, nbRegisters, codeDumpSize, stackDumpSize, additionalDataSize = hdr[2:]
     nbRegisters //= 4
 
     processor, coreId = processor & 0xffff, processor >> 16
@@ -95,84 +163,94 @@ def main(args=None):
     if version < (1 << 16) | 2:
         raise SystemExit("Incompatible format version, please use the appropriate parser.")
 
-    registers = unpack_from("<{0}I".format(nbRegisters), data, 40)
+    regStruct = _REG_CACHE.get(nbRegisters)
+    if regStruct is None:
+        regStruct = _REG_CACHE[nbRegisters] = Struct(f"<{nbRegisters}I")
+    registers = regStruct.unpack_from(data, 40)
     codeOffset = 40 + 4 * nbRegisters
-    codeDump = data[codeOffset : codeOffset + codeDumpSize]
+    mv = memoryview(data)
+    codeDump = mv[codeOffset : codeOffset + codeDumpSize]
     stackOffset = codeOffset + codeDumpSize
-    stackDump = data[stackOffset : stackOffset + stackDumpSize]
+    stackDump = mv[stackOffset : stackOffset + stackDumpSize]
     addtionalDataOffset = stackOffset + stackDumpSize
-    additionalData = data[addtionalDataOffset : addtionalDataOffset + additionalDataSize]
+    additionalData = mv[addtionalDataOffset : addtionalDataOffset + additionalDataSize]
 
     if processor == 9: print("Processor: Arm9")
-    else: print("Processor: Arm11 (core {0})".format(coreId))
+    else: print(f"Processor: Arm11 (core {coreId})")
 
+    thumbBit = registers[16] & 0x20
     typeDetailsStr = ""
     if exceptionType == 2:
-        if (registers[16] & 0x20) == 0 and codeDumpSize >= 4:
-            instr = unpack_from("<I", codeDump[-4:])[0]
+        if not thumbBit and len(codeDump) >= 4:
+            instr = _U32.unpack_from(codeDump[-4:])[0]
             if instr == 0xe12fff7e:
                 typeDetailsStr = " (kernel panic)"
             elif instr == 0xef00003c:
                 typeDetailsStr = " " + (svcBreakReasons[registers[0]] if registers[0] < 3 else "(svcBreak)")
-        elif (registers[16] & 0x20) == 1 and codeDumpSize >= 2:
-            instr = unpack_from("<I", codeDump[-4:])[0]
+        elif thumbBit and len(codeDump) >= 2:
+            instr = _U16.unpack_from(codeDump[-2:])[0]
             if instr == 0xdf3c:
                 typeDetailsStr = " " + (svcBreakReasons[registers[0]] if registers[0] < 3 else "(svcBreak)")
 
     elif processor != 9 and (registers[20] & 0x80000000) != 0:
         typeDetailsStr = " (VFP exception)"
 
-    print("Exception type: {0}{1}".format("unknown" if exceptionType >= len(handledExceptionNames) else handledExceptionNames[exceptionType], typeDetailsStr))
+    exceptionName = "unknown" if exceptionType >= len(handledExceptionNames) else handledExceptionNames[exceptionType]
+    print(f"Exception type: {exceptionName}{typeDetailsStr}")
 
     if processor == 11 and exceptionType >= 2:
         xfsr = registers[18] if exceptionType == 2 else registers[17]
-        print("Fault status: " + faultStatusSources[xfsr & 0xf])
+        print("Fault status: " + _FSR[xfsr & 0xf])
 
     if additionalDataSize != 0:
         if processor == 11:
-            print("Current process: {0} ({1:016x})".format(additionalData[:8].decode("ascii"), unpack_from("<Q", additionalData, 8)[0]))
+            print(f"Current process: {str(additionalData[:8], 'ascii')} ({_U64.unpack_from(additionalData, 8)[0]:016x})")
         else:
-            outName = os.path.splitext(args.filename)[0] + "_arm9mem.bin"
-            with open(outName, "wb+") as f:
-                f.write(additionalData)
+            outName = os.path.splitext(filename)[0] + "_arm9mem.bin"
+            fd = os.open(outName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+            try:
+                written = 0
+                while written < len(additionalData):
+                    n = os.write(fd, additionalData[written:])
+                    if n == 0:
+                        raise OSError(f"Failed to write {outName}")
+                    written += n
+            finally:
+                os.close(fd)
 
             # We don't care if we fail, I guess
-            print("Arm9 RAM dumped to {0}, size {1:x}".format(outName, additionalDataSize))
+            print(f"Arm9 RAM dumped to {outName}, size {additionalDataSize:x}")
 
-    print("\nRegister dump:\n")
-    for i in range(0, nbRegisters - (nbRegisters % 2), 2):
-        if i == 16: print("")
-        print(makeRegisterLine(registerNames[i], registers[i], registerNames[i+1], registers[i+1]))
-    if nbRegisters % 2 == 1: print("{0:<15}{1:<20}".format(registerNames[nbRegisters - 1], "{0:08x}".format(registers[nbRegisters - 1])))
+    # cpsr and the registers after it are separated from the GPRs by a blank line
+    nbPaired = nbRegisters - (nbRegisters % 2)
+    regLines = [f"{nA:<15}{rA:08x}{'':<12}{nB:<15}{rB:08x}{'':<12}" for nA, rA, nB, rB in
+                zip(registerNames[0:nbPaired:2], registers[0:nbPaired:2], registerNames[1:nbPaired:2], registers[1:nbPaired:2])]
+    lines = ["", "Register dump:", ""] + regLines[:8] + ([""] if nbPaired > 16 else []) + regLines[8:]
+    if nbRegisters % 2 == 1: lines.append(f"{registerNames[nbRegisters - 1]:<15}{registers[nbRegisters - 1]:08x}{'':<12}")
 
     if processor == 11 and exceptionType == 3:
-        print("{0:<15}{1:<20}Access type: {2}".format("FAR", "{0:08x}".format(registers[19]), "Write" if registers[17] & (1 << 11) != 0 else "Read"))
+        lines.append(f"{'FAR':<15}{registers[19]:08x}{'':<12}Access type: {'Write' if registers[17] & (1 << 11) != 0 else 'Read'}")
 
-    thumb = registers[16] & 0x20 != 0
-    addr = registers[15] - codeDumpSize + (2 if thumb else 4)
+    sys.stdout.write('\n'.join(lines) + '\n')
 
-    print("\nCode dump:\n")
-
-    objdump_res = ""
-    try:
-        path = os.path.join(os.environ["DEVKITARM"], "bin", "arm-none-eabi-objdump")
-
-        if os.name == "nt" and path[0] == '/':
-            path = ''.join((path[1], ':', path[2:]))
-
-        objdump_res = subprocess.check_output((
-                                                    path, "-marm", "-b", "binary",
-                                                     "--adjust-vma="+hex(addr - codeOffset), "--start-address="+hex(addr),
-                                                     "--stop-address="+hex(addr + codeDumpSize), "-D", "-z", "-M",
-                                                     "reg-names-std" + (",force-thumb" if thumb else ""), args.filename
-                                             )).decode("utf-8")
-        objdump_res = '\n'.join(objdump_res[objdump_res.find('<.data+'):].split('\n')[1:])
-    except: objdump_res = ""
-
-    print(objdump_res if objdump_res != "" else hexdump(addr, codeDump))
+    thumb = thumbBit != 0
+    addr = registers[15] - codeDumpSize + (2 if thumb else 4)
 
-    print("\nStack dump:\n")
-    print(hexdump(registers[13], stackDump))
+    objdump_res = disassemble(addr, codeDump, thumb)
+    if objdump_res == "" and _OBJDUMP_PATH is not None:
+        # Only needed for this fallback, so don't pay for the import otherwise
+        import subprocess
+        try:
+            argv = (_OBJDUMP_PATH, "-marm", "-b", "binary",
+                    f"--adjust-vma={addr - codeOffset:#x}", f"--start-address={addr:#x}",
+                    f"--stop-address={addr + codeDumpSize:#x}", "-D", "-z", "-M",
+                    _REGNAMES_THUMB if thumb else _REGNAMES_ARM, filename)
+            objdump_res = subprocess.check_output(argv, stdin=subprocess.DEVNULL, close_fds=False).decode("utf-8")
+            objdump_res = '\n'.join(objdump_res[objdump_res.find('<.data+'):].split('\n')[1:])
+        except: objdump_res = ""
+
+    codeStr = objdump_res if objdump_res != "" else hexdump(addr, codeDump)
+    sys.stdout.write(f"\nCode dump:\n\n{codeStr}\n\nStack dump:\n\n{hexdump(registers[13], stackDump)}\n")
 
 if __name__ == "__main__":
     main()
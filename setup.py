@@ -7,7 +7,9 @@ setup(
     author='TuxSH',
     license='GPLv3',
     description='Parses Luma3DS exception dumps',
+    python_requires='>=3.8',
     install_requires=[''],
+    extras_require={'capstone': ['capstone']},
     packages=find_packages(),
     entry_points={'console_scripts': ['luma3ds_exception_dump_parser=luma3ds_exception_dump_parser.__main__:main']},
 )